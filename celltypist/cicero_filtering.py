@@ -4,14 +4,18 @@
 import argparse
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from glob import glob
-from typing import Set
+from typing import Tuple
 
 import numpy as np
-import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv as pa_csv
+from pyarrow import parquet as pq
 from tqdm import tqdm
 from scipy import io
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, save_npz
 import shutil
 
 
@@ -39,6 +43,29 @@ def parse_args() -> argparse.Namespace:
         required=True,
         help="Cicero coaccessibility threshold (e.g. 0.1)",
     )
+    p.add_argument(
+        "--out_format",
+        choices=["mtx", "npz"],
+        default="mtx",
+        help=(
+            "Format of the reduced matrix: MatrixMarket matrix.mtx (default, scOpen input) "
+            "or binary scipy sparse matrix.npz"
+        ),
+    )
+    p.add_argument(
+        "--threads",
+        type=int,
+        default=2,
+        help=(
+            "Cicero files parsed concurrently (default: 2). Each file is already parsed "
+            "multithreaded by Arrow; every extra worker keeps another chromosome table in memory"
+        ),
+    )
+    p.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Do not read or write peaks_chr*.parquet caches next to the Cicero CSV files",
+    )
     p.add_argument(
         "--quiet",
         action="store_true",
@@ -52,6 +79,90 @@ def log(msg: str, quiet: bool = False) -> None:
         print(msg, flush=True)
 
 
+PEAK_TO_BED = str.maketrans("_", "\t")
+
+CICERO_COLUMN_TYPES = {
+    "Peak1": pa.large_string(),
+    "Peak2": pa.large_string(),
+    # float64 like --coacc_thresh, so values equal to the threshold are kept
+    "coaccess": pa.float64(),
+}
+
+
+def read_connections_csv(path: str) -> pa.Table:
+    # Cicero's R output quotes peak IDs; let the CSV reader unquote them while parsing
+    return pa_csv.read_csv(
+        path,
+        parse_options=pa_csv.ParseOptions(quote_char='"', double_quote=True),
+        convert_options=pa_csv.ConvertOptions(
+            column_types=CICERO_COLUMN_TYPES,
+            include_columns=list(CICERO_COLUMN_TYPES),
+        ),
+    )
+
+
+def write_connections_cache(tbl: pa.Table, pq_path: str) -> None:
+    """
+    Cache a parsed Cicero table as Parquet (dictionary-encoded peak IDs),
+    sorted by coaccess so row-group statistics let threshold filters skip I/O.
+    """
+    tmp_path = f"{pq_path}.tmp{os.getpid()}"
+    try:
+        pq.write_table(tbl.sort_by("coaccess"), tmp_path, row_group_size=1 << 17)
+        os.replace(tmp_path, pq_path)
+    except OSError:
+        # cache is best-effort (e.g. read-only Cicero output)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def filter_connections(
+    path: str, coacc_thresh: float, core_arr: pa.Array, use_cache: bool = True
+) -> Tuple[int, int, pa.Array]:
+    """
+    Read one Cicero peaks_chr*.csv and keep connections with coaccess >= threshold
+    that touch at least one core peak. With use_cache, a peaks_chr*.parquet next to
+    the CSV is read instead when it is up to date, and written after parsing otherwise.
+    Returns (#connections, #core-related connections, unique peak IDs of those connections).
+    """
+    pq_path = os.path.splitext(path)[0] + ".parquet"
+    if use_cache and os.path.isfile(pq_path) and os.path.getmtime(pq_path) >= os.path.getmtime(path):
+        total = pq.ParquetFile(pq_path).metadata.num_rows
+        # threshold pushed down into the Parquet reader
+        tbl = pq.read_table(
+            pq_path,
+            columns=list(CICERO_COLUMN_TYPES),
+            filters=[("coaccess", ">=", coacc_thresh)],
+        )
+    else:
+        tbl = read_connections_csv(path)
+        total = tbl.num_rows
+        if use_cache:
+            write_connections_cache(tbl, pq_path)
+
+        # threshold by coaccessibility before touching the peak strings
+        tbl = tbl.filter(pc.greater_equal(tbl["coaccess"], coacc_thresh))
+
+    # strip residual quotes (if any) on the thresholded rows only
+    p1 = pc.utf8_trim(tbl["Peak1"], characters='"')
+    p2 = pc.utf8_trim(tbl["Peak2"], characters='"')
+
+    # encode both peak columns against one shared vocabulary, so core membership
+    # is hashed once per distinct peak and rows are selected by integer codes
+    n = len(p1)
+    encoded = pa.chunked_array(p1.chunks + p2.chunks, type=pa.large_string()).combine_chunks().dictionary_encode()
+    vocab = encoded.dictionary
+    codes = encoded.indices.to_numpy()
+    codes1, codes2 = codes[:n], codes[n:]
+
+    # keep connections touching the core
+    vocab_in_core = pc.is_in(vocab, value_set=core_arr).to_numpy(zero_copy_only=False)
+    mask = vocab_in_core[codes1] | vocab_in_core[codes2]
+
+    peak_codes = np.unique(np.concatenate([codes1[mask], codes2[mask]]))
+    return total, int(mask.sum()), vocab.take(pa.array(peak_codes))
+
+
 def main() -> int:
     args = parse_args()
     data_name = args.data_name
@@ -90,12 +201,16 @@ def main() -> int:
     os.makedirs(out_dir, exist_ok=True)
 
     # ---------- load core peaks ----------
+    # one Arrow hash build, reused as the is_in value set for every file
     with open(core_file) as f:
-        core_peak_ids: Set[str] = {
-            line.strip().strip('"') for line in f if line.strip()
-        }
+        core_arr = pc.unique(
+            pa.array(
+                [line.strip().strip('"') for line in f if line.strip()],
+                type=pa.large_string(),
+            )
+        )
 
-    log(f"[INFO] Core peaks: {len(core_peak_ids)}", quiet)
+    log(f"[INFO] Core peaks: {len(core_arr)}", quiet)
 
     # ---------- iterate Cicero coaccessibility files ----------
     files = sorted(glob(os.path.join(cicero_filtered_dir, "peaks_chr*.csv")))
@@ -108,42 +223,40 @@ def main() -> int:
 
     log(f"[INFO] Found {len(files)} Cicero files", quiet)
 
-    selected_peak_ids = set(core_peak_ids)
+    # per-file unique peaks, deduplicated together with the core once at the end
+    peak_chunks = [core_arr]
 
     total_connections = 0
     core_connections = 0
 
-    for file in tqdm(files, disable=quiet):
-        df = pd.read_csv(file)
-        total_connections += df.shape[0]
-
-        # normalize peak IDs
-        df["Peak1"] = df["Peak1"].astype(str).str.replace('"', '')
-        df["Peak2"] = df["Peak2"].astype(str).str.replace('"', '')
-
-        # threshold by coaccessibility
-        df_thr = df[df["coaccess"] >= coacc_thresh]
-
-        # keep connections touching the core
-        mask = df_thr["Peak1"].isin(core_peak_ids) | df_thr["Peak2"].isin(core_peak_ids)
-        df_core = df_thr[mask]
-
-        core_connections += df_core.shape[0]
-
-        selected_peak_ids.update(df_core["Peak1"].tolist())
-        selected_peak_ids.update(df_core["Peak2"].tolist())
+    # chromosome files are independent; Arrow releases the GIL while parsing
+    with ThreadPoolExecutor(max_workers=max(1, min(args.threads, len(files)))) as pool:
+        futures = [
+            pool.submit(filter_connections, file, coacc_thresh, core_arr, not args.no_cache)
+            for file in files
+        ]
+        for future in tqdm(as_completed(futures), total=len(futures), disable=quiet):
+            total, core, peaks = future.result()
+            total_connections += total
+            core_connections += core
+            peak_chunks.append(peaks)
+
+    selected = pc.unique(pa.chunked_array(peak_chunks, type=pa.large_string()))
+    selected = selected.take(pc.array_sort_indices(selected))
 
     log(f"[INFO] Total connections: {total_connections}", quiet)
     log(f"[INFO] Core-related connections: {core_connections}", quiet)
     log(
-        f"[INFO] Selected peaks (core + coaccessible): {len(selected_peak_ids)}",
+        f"[INFO] Selected peaks (core + coaccessible): {len(selected)}",
         quiet,
     )
 
     # ---------- save selected peak IDs ----------
-    with open(out_file, "w") as f:
-        for pid in sorted(selected_peak_ids):
-            f.write(pid + "\n")
+    pa_csv.write_csv(
+        pa.table({"peak": selected}),
+        out_file,
+        write_options=pa_csv.WriteOptions(include_header=False, quoting_style="none"),
+    )
 
     log(f"[INFO] Selected peak list saved to: {out_file}", quiet)
 
@@ -158,13 +271,17 @@ def main() -> int:
 
     log(f"[INFO] Peaks in original matrix: {len(all_peak_ids)}", quiet)
 
-    idx = [i for i, pid in enumerate(all_peak_ids) if pid in selected_peak_ids]
-    if not idx:
+    # hash-based membership in Arrow (np.isin on object arrays is O(N*M))
+    keep_mask = pc.is_in(
+        pa.array(all_peak_ids, type=pa.large_string()),
+        value_set=selected,
+    ).to_numpy(zero_copy_only=False)
+    idx = np.flatnonzero(keep_mask).astype(np.int32)
+    if idx.size == 0:
         raise RuntimeError(
             "No selected peaks found in peaks.txt — check peak ID format."
         )
 
-    idx = np.array(idx, dtype=int)
     log(f"[INFO] Peaks retained: {len(idx)}", quiet)
 
     mat_path = os.path.join(cicero_dir, "matrix.mtx")
@@ -175,26 +292,33 @@ def main() -> int:
     mat = io.mmread(mat_path).tocsr()
     log(f"[INFO] Original matrix shape: {mat.shape}", quiet)
 
+    # idx is already ascending (np.flatnonzero); with a matching index dtype and
+    # sorted column indices scipy slices rows directly via csr_row_index
+    idx = idx.astype(mat.indptr.dtype, copy=False)
+    mat.sort_indices()
     mat_core = mat[idx, :]
     log(f"[INFO] Reduced matrix shape: {mat_core.shape}", quiet)
 
     # ---------- write scOpen input ----------
-    core_peak_ids_ordered = [all_peak_ids[i] for i in idx]
+    # one buffer for all retained peak IDs; peaks.bed is the same text with
+    # chr_start_end turned into tab-separated columns
+    peaks_txt = "\n".join([all_peak_ids[i] for i in idx]) + "\n"
 
     with open(os.path.join(out_dir, "peaks.txt"), "w") as f:
-        for pid in core_peak_ids_ordered:
-            f.write(pid + "\n")
+        f.write(peaks_txt)
 
     with open(os.path.join(out_dir, "peaks.bed"), "w") as f:
-        for pid in core_peak_ids_ordered:
-            f.write(pid.replace("_", "\t") + "\n")
+        f.write(peaks_txt.translate(PEAK_TO_BED))
 
     shutil.copy(
         os.path.join(cicero_dir, "barcodes.tsv"),
         os.path.join(out_dir, "barcodes.tsv"),
     )
 
-    io.mmwrite(os.path.join(out_dir, "matrix.mtx"), mat_core)
+    if args.out_format == "npz":
+        save_npz(os.path.join(out_dir, "matrix.npz"), mat_core, compressed=False)
+    else:
+        io.mmwrite(os.path.join(out_dir, "matrix.mtx"), mat_core)
 
     log(f"[DONE] scOpen input written to: {out_dir}", quiet)
     return 0
@@ -4,11 +4,12 @@
 import argparse
 import os
 import sys
-from typing import Optional
 
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv as pa_csv
 from celltypist import models
 
 
@@ -65,24 +66,6 @@ def log(msg: str, quiet: bool = False) -> None:
         print(msg, flush=True)
 
 
-def parse_attr(attrs: str, key: str) -> Optional[str]:
-    """
-    Parse GTF attributes field and return value for a given key.
-    Example fragment: gene_name "ABCD"; gene_id "ENSG...";
-    """
-    if not isinstance(attrs, str):
-        return None
-    for part in attrs.split(";"):
-        part = part.strip()
-        if not part:
-            continue
-        # GTF style: key "value"
-        if part.startswith(key + " "):
-            val = part.split(" ", 1)[1].strip().strip('"')
-            return val
-    return None
-
-
 def main() -> int:
     args = parse_args()
 
@@ -124,7 +107,8 @@ def main() -> int:
         print("[ERROR] Model classifier has no 'classes_' attribute with cell types.", file=sys.stderr)
         return 5
 
-    weights = clf.coef_  # (n_classes, n_genes)
+    # (n_classes, n_genes); float32 is enough for ranking by |coef|
+    weights = np.ascontiguousarray(clf.coef_, dtype=np.float32)
     genes = np.array(clf.features)
     celltypes = np.array(clf.classes_)
 
@@ -145,41 +129,34 @@ def main() -> int:
         top_n = len(genes)
 
     # Build core genes and per-class table
-    top_genes_per_class = []
-    rows = []
-
     log("[INFO] Selecting top genes per class by |coef|...", quiet)
-    for i, ct in tqdm(list(enumerate(celltypes)), disable=quiet):
-        class_weights = weights[i, :]
-        idx_sorted = np.argsort(np.abs(class_weights))[::-1]
-        idx_top = idx_sorted[:top_n]
-
-        genes_top = genes[idx_top]
-        weights_top = class_weights[idx_top]
-
-        top_genes_per_class.append(set(genes_top.tolist()))
-
-        for g, w in zip(genes_top, weights_top):
-            rows.append(
-                {
-                    "cell_type": str(ct),
-                    "gene": str(g),
-                    "weight": float(w),
-                    "abs_weight": float(abs(w)),
-                }
-            )
-
-    core_genes = sorted(set().union(*top_genes_per_class))
+    abs_w = np.abs(weights)
+    top_idx = np.argpartition(abs_w, abs_w.shape[1] - top_n, axis=1)[:, -top_n:]
+    # order the top-N of each class by |coef| descending
+    order = np.argsort(-np.take_along_axis(abs_w, top_idx, axis=1), axis=1)
+    top_idx = np.take_along_axis(top_idx, order, axis=1)
+    # report the selected weights at the model's full precision
+    weights_top = np.take_along_axis(np.asarray(clf.coef_), top_idx, axis=1).ravel()
+
+    df = pd.DataFrame(
+        {
+            "cell_type": np.repeat(celltypes, top_n).astype(str),
+            "gene": genes[top_idx].ravel().astype(str),
+            "weight": weights_top,
+            "abs_weight": np.abs(weights_top),
+        }
+    )
+
+    # unique on int indices first; the final np.unique only sorts (and dedups
+    # repeated feature names) the already-small gathered gene set
+    core_genes = np.unique(genes[np.unique(top_idx)])
     log(f"[INFO] Core genes (unique union): {len(core_genes)}", quiet)
 
     # Save core gene list
-    with open(out_genes_list, "w") as f:
-        for g in core_genes:
-            f.write(g + "\n")
+    np.savetxt(out_genes_list, core_genes, fmt="%s")
     log(f"[INFO] Saved core gene list: {out_genes_list}", quiet)
 
     # Save detailed table
-    df = pd.DataFrame(rows)
     df.sort_values(["cell_type", "abs_weight"], ascending=[True, False], inplace=True)
     df.to_csv(out_table, index=False)
     log(f"[INFO] Saved per-class table: {out_table}", quiet)
@@ -192,30 +169,40 @@ def main() -> int:
 
     log(f"[INFO] Loading GTF: {gtf_file}", quiet)
     gtf_cols = ["chr", "source", "feature", "start", "end", "score", "strand", "frame", "attributes"]
-    gtf = pd.read_csv(
+    gtf_types = {
+        "chr": pa.string(),
+        "feature": pa.string(),
+        "start": pa.int64(),
+        "end": pa.int64(),
+        "strand": pa.string(),
+        "attributes": pa.string(),
+    }
+
+    def skip_comment(row) -> str:
+        # '##' header / '#' comment lines have a single field
+        return "skip" if row.text.startswith("#") else "error"
+
+    gtf = pa_csv.read_csv(
         gtf_file,
-        sep="\t",
-        comment="#",
-        header=None,
-        names=gtf_cols,
-        dtype={
-            "chr": str,
-            "source": str,
-            "feature": str,
-            "start": int,
-            "end": int,
-            "strand": str,
-            "attributes": str,
-        },
-        low_memory=False,
+        read_options=pa_csv.ReadOptions(column_names=gtf_cols),
+        # attributes contain literal quotes: gene_name "ABCD";
+        parse_options=pa_csv.ParseOptions(
+            delimiter="\t", quote_char=False, invalid_row_handler=skip_comment
+        ),
+        convert_options=pa_csv.ConvertOptions(
+            column_types=gtf_types, include_columns=list(gtf_types)
+        ),
     )
 
-    gtf_genes = gtf[gtf["feature"] == "gene"].copy()
+    gtf = gtf.filter(pc.equal(gtf["feature"], "gene"))
+    gtf_genes = gtf.to_pandas(types_mapper=pd.ArrowDtype)
     log(f"[INFO] GTF gene features: {len(gtf_genes)}", quiet)
 
     # Extract gene_name
     log("[INFO] Parsing gene_name from attributes...", quiet)
-    gtf_genes["gene_name"] = gtf_genes["attributes"].apply(lambda x: parse_attr(x, "gene_name"))
+    # GTF style: key "value"; ...
+    gtf_genes["gene_name"] = gtf_genes["attributes"].str.extract(r'(?:^|;)\s*gene_name "(?P<gene_name>[^"]*)"', expand=False)
+    gtf_genes.drop(columns=["attributes"], inplace=True)
 
     # Keep only core genes
     gtf_core = gtf_genes[gtf_genes["gene_name"].isin(core_genes)].copy()
@@ -226,34 +213,34 @@ def main() -> int:
         return 9
 
     # Compute TSS (GTF is 1-based inclusive)
-    def tss_row(row) -> int:
-        return int(row["start"]) if row["strand"] == "+" else int(row["end"])
-
-    gtf_core["tss"] = gtf_core.apply(tss_row, axis=1)
+    tss = np.where(
+        (gtf_core["strand"] == "+").to_numpy(dtype=bool),
+        gtf_core["start"].to_numpy(dtype=np.int64),
+        gtf_core["end"].to_numpy(dtype=np.int64),
+    )
 
-    bed_rows = []
     log(f"[INFO] Building BED windows: TSS±{window} bp...", quiet)
-    for _, r in tqdm(gtf_core.iterrows(), total=len(gtf_core), disable=quiet):
-        tss = int(r["tss"])
-        # Convert to BED 0-based half-open:
-        # TSS in GTF is 1-based position; BED start is 0-based.
-        start = max(0, tss - 1 - window)
-        end = tss + window  # == tss + window in 1-based coordinates
-        bed_rows.append(
-            {
-                "chr": r["chr"],
-                "start": start,
-                "end": end,
-                "name": r["gene_name"],
-                "strand": r["strand"],
-            }
-        )
-
-    bed = pd.DataFrame(bed_rows)
+    # Convert to BED 0-based half-open:
+    # TSS in GTF is 1-based position; BED start is 0-based.
+    bed = pd.DataFrame(
+        {
+            "chr": gtf_core["chr"].to_numpy(),
+            "start": np.maximum(0, tss - 1 - window).astype(np.int32),
+            "end": (tss + window).astype(np.int32),  # == tss + window in 1-based coordinates
+            "name": gtf_core["gene_name"].to_numpy(),
+            "strand": gtf_core["strand"].to_numpy(),
+        }
+    )
     bed.dropna(subset=["chr", "start", "end", "name"], inplace=True)
     bed.sort_values(["chr", "start", "end", "name"], inplace=True)
 
-    bed.to_csv(out_bed, sep="\t", header=False, index=False)
+    pa_csv.write_csv(
+        pa.Table.from_pandas(bed, preserve_index=False),
+        out_bed,
+        write_options=pa_csv.WriteOptions(
+            include_header=False, delimiter="\t", quoting_style="none"
+        ),
+    )
     log(f"[INFO] Saved BED: {out_bed}", quiet)
 
     log("[DONE] Core genes + regions generated successfully.", quiet)
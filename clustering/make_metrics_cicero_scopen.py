@@ -29,38 +29,28 @@ def main():
     else:
         output_csv = args.output
 
-    rows = []
+    names = []
+    metrics = []
 
-    for name in sorted(os.listdir(base_dir)):
-        folder = os.path.join(base_dir, name)
-        if not os.path.isdir(folder):
-            continue
+    with os.scandir(base_dir) as it:
+        folders = sorted((e for e in it if e.is_dir()), key=lambda e: e.name)
 
-        metrics_path = os.path.join(folder, "metrics.json")
+    for entry in folders:
+        metrics_path = os.path.join(entry.path, "metrics.json")
         if not os.path.exists(metrics_path):
             continue
 
         with open(metrics_path, "r") as f:
-            metrics = json.load(f)
-
-        row = {"matrix_name": name}
-
-        # flatten metrics dict
-        def flatten(prefix, d):
-            for k, v in d.items():
-                if isinstance(v, dict):
-                    flatten(f"{prefix}{k}_", v)
-                else:
-                    row[f"{prefix}{k}"] = v
-
-        flatten("", metrics)
-        rows.append(row)
+            metrics.append(json.load(f))
+        names.append(entry.name)
 
-    if not rows:
+    if not metrics:
         print("Не найдено ни одного metrics.json в", base_dir)
         return
 
-    df = pd.DataFrame(rows)
+    # flatten nested metrics dicts into prefix_key columns
+    df = pd.json_normalize(metrics, sep="_")
+    df.insert(0, "matrix_name", names)
     df = df.sort_values("matrix_name")
 
     df.to_csv(output_csv, index=False)